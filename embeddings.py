@@ -1,5 +1,3 @@
-from langchain_openai import OpenAIEmbeddings
-
 import os
 from dotenv import load_dotenv
 
@@ -10,6 +8,7 @@ CHROMA_COLLECTION = os.getenv('CHROMA_COLLECTION_DESC')
 
 def get_embedding_function():
     """Returns an OpenAIEmbeddings object that can be used with Chroma"""
+    from langchain_openai import OpenAIEmbeddings
     return OpenAIEmbeddings(
         model="text-embedding-3-small",
         openai_api_key=os.getenv('OPENAI_API_KEY')
@@ -1,14 +1,22 @@
 import os
+import re
+import sys
+import ast
+import math
+import atexit
+import asyncio
+import functools
 import logging
-from openai import OpenAI
-from langchain_chroma import Chroma
-from langchain.prompts import ChatPromptTemplate
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, TypedDict
 from dotenv import load_dotenv
 from embeddings import get_embedding_function
 from pathlib import Path
 
-from pocketflow import Node, Flow
-from langchain_openai import ChatOpenAI
+from pocketflow import Node, AsyncNode, Flow
+
+# Heavy dependencies (langchain, openai, httpx, nbformat) are imported on first use to keep cold start fast
 
 load_dotenv()
 CHROMA_PATH = os.getenv('CHROMA_PATH')
@@ -16,16 +24,18 @@ CHROMA_COLLECTION = os.getenv('CHROMA_COLLECTION_DESC')
 FILE_PATH = os.getenv('FILE_PATH')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
-PROMPT_TEMPLATE = """
+# Everything that does not change between requests lives in the system message so the
+# prompt starts with a stable prefix that OpenAI can serve from its prompt cache.
+SYSTEM_TEMPLATE = """
 You are an expert in CadQuery and Python. Given the following context, generate **only** valid, functional CadQuery code that follows best practices. Ensure the code does not contain syntax errors and is executable.
 
-Context:
-{context}
+Guidelines document:
+{guidelines}
 
 ---
 
-Task: Generate CadQuery code for the following request:
-{question}
+Examples:
+{examples}
 
 **Guidelines:**
 - Use `cq.Workplane` properly.
@@ -38,9 +48,60 @@ Task: Generate CadQuery code for the following request:
 - If creating a symmetrical object, create half of it and use .mirror() to complete it.
 - Always ensure that objects are created at the origin (0, 0, 0) unless otherwise specified.
 
-Output only the CadQuery code:
+Output only the CadQuery code.
+"""
+
+# Request specific parts go last
+HUMAN_TEMPLATE = """
+Context:
+{context}
+
+---
+
+Task: Generate CadQuery code for the following request:
+{question}
+"""
+
+FEW_SHOT_EXAMPLES = """
+---
+Example 1:
+Request: Create a cylinder with a 1-inch diameter and 2-inch height.
+Output:
+import cadquery as cq
+result = cq.Workplane("XY").circle(0.5).extrude(2)
+---
+
+Example 2:
+Request: Create a nut with a 1/2 inch diameter.
+Output:
+import cadquery as cq
+diameter = 0.5
+height = 0.25
+result = (cq.Workplane("XY").circle(diameter / 2).extrude(height)
+    .faces("<Z").workplane().hole(diameter / 4))
+---
+"""
+
+REVIEW_TEMPLATE = """
+Review the following CadQuery request, the documentation retrieved for it and the code generated from it.
+
+Request: {question}
+
+Context:
+{context}
+
+---
+
+Code:
+{code}
 """
 
+class GenerationReview(TypedDict):
+    """Review of the retrieved context and the generated code, done in a single LLM call."""
+    context_ok: Annotated[bool, ..., "Whether the context is relevant to the request"]
+    code_ok: Annotated[bool, ..., "Whether the code is valid CadQuery that fulfils the request"]
+    reasons: Annotated[str, ..., "Short explanation of both judgements"]
+
 # Ensure USER_AGENT is set
 if 'USER_AGENT' not in os.environ:
     os.environ['USER_AGENT'] = "cadgpt"
@@ -49,214 +110,413 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "./credentials.json"
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 
-# Set up OpenAI API key
-OpenAI.api_key = OPENAI_API_KEY
+# Shared async transport with HTTP/2 and a pool large enough for the parallel ainvoke fan-out
+@functools.lru_cache(maxsize=1)
+def _get_http_async_client():
+    import httpx
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        timeout=60,
+    )
+
+# The async client's connections are bound to the loop they were opened on, so reuse one loop per process.
+# Only created when the async path (verbose mode) is used.
+@functools.lru_cache(maxsize=1)
+def _get_event_loop():
+    loop = asyncio.new_event_loop()
+    atexit.register(_close_event_loop, loop)
+    return loop
 
-# Define a reusable model creator function
-def get_openai_model(temperature=0.2):
+def _close_event_loop(loop):
+    if _get_http_async_client.cache_info().currsize:
+        loop.run_until_complete(_get_http_async_client().aclose())
+    loop.close()
+
+# Define a reusable model creator function, cached so the client and its connection pool are reused
+# Only code generation needs the reasoning model, auxiliary tasks (analysis, evaluation, ...) use a cheaper one.
+# Generation only streams synchronously, so only the auxiliary models get the shared async transport.
+@functools.lru_cache(maxsize=8)
+def get_openai_model(temperature=0.2, task="aux"):
+    from langchain_openai import ChatOpenAI
+    if task == "generate":
+        return ChatOpenAI(
+            model="o3-mini",
+            openai_api_key=os.getenv('OPENAI_API_KEY'),
+            reasoning_effort="medium",
+        )
     return ChatOpenAI(
-        model="o3-mini",
+        model="gpt-4o-mini",
         openai_api_key=os.getenv('OPENAI_API_KEY'),
-        reasoning_effort="medium",
+        temperature=temperature,
+        http_async_client=_get_http_async_client(),
     )
 
-class RetrieveContext(Node):
-    def prep(self, shared):
-        return shared["query"]
-    
-    def exec(self, query):
-        # Get the embedding object
-        embedding_function = get_embedding_function()
+# Embedding function and vector store are heavy to initialise, build them once per process
+_EMBEDDING = None
+_VECTOR_STORE = None
+
+def _get_embedding():
+    global _EMBEDDING
+    if _EMBEDDING is None:
+        _EMBEDDING = get_embedding_function()
+    return _EMBEDDING
 
-        # Use it with Chroma
-        vector_store = Chroma(
+def _get_vector_store():
+    global _VECTOR_STORE
+    if _VECTOR_STORE is None:
+        from langchain_chroma import Chroma
+        _VECTOR_STORE = Chroma(
             persist_directory=CHROMA_PATH,
             collection_name=CHROMA_COLLECTION,
-            embedding_function=embedding_function
+            embedding_function=_get_embedding()
         )
+    return _VECTOR_STORE
+
+# Embed each query once, shared by the semantic response cache and the Chroma search
+@functools.lru_cache(maxsize=256)
+def _embed_query(query):
+    return tuple(_get_embedding().embed_query(query))
+
+# Retrieval is deterministic for a given query, memoize it so repeat queries skip the index search
+@functools.lru_cache(maxsize=256)
+def _search(query, k):
+    results = _get_vector_store().similarity_search_by_vector_with_relevance_scores(list(_embed_query(query)), k=k)
+    # Scores are distances, lower means more relevant so keep the best matches first
+    return tuple(sorted(results, key=lambda x: x[1]))
+
+# Chroma returns distances (lower is better), chunks further away than this are treated as noise.
+# The collection uses Chroma's default squared L2 metric on normalised OpenAI embeddings,
+# where distance = 2 - 2 * cosine similarity, so 1.2 keeps chunks with a cosine similarity of 0.4 or more.
+MAX_CONTEXT_DISTANCE = 1.2
+
+# Calls the guidelines forbid, generated code using them is regenerated
+BANNED_FUNCTIONS = ("show_object",)
+BANNED_METHODS = ("cylinder",)
+MAX_GENERATION_ATTEMPTS = 3
+
+# Semantic response cache: (query embedding, numbers, code response, sources) of previous queries,
+# bounded since every lookup compares against all entries
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_SIZE = 128
+_RESPONSE_CACHE = deque(maxlen=SEMANTIC_CACHE_SIZE)
+
+def _cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
 
-        # When performing similarity search, pass the query as a string
-        results = vector_store.similarity_search_with_score(query, k=5)
-        return sorted(results, key=lambda x: x[1], reverse=True)
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+def extract_numbers(query):
+    # Dimensions barely move the embedding, so a cached response only applies to the exact same numbers
+    return tuple(_NUMBER_RE.findall(query))
+
+def _lookup_cached_response(query_embedding, numbers):
+    best_score, best_entry = 0.0, None
+    for embedding, cached_numbers, code_response, sources in _RESPONSE_CACHE:
+        if cached_numbers != numbers:
+            continue
+        score = _cosine_similarity(query_embedding, embedding)
+        if score > best_score:
+            best_score, best_entry = score, (code_response, sources)
+    if best_score >= SEMANTIC_CACHE_THRESHOLD:
+        return best_entry
+    return None
+
+_FENCE_RE = re.compile(r"```(?:python)?")
+
+def strip_code_fences(code_response):
+    return _FENCE_RE.sub("", code_response).strip()
+
+def find_banned_calls(tree):
+    # Walk the AST so mentions in comments and strings are not flagged
+    banned = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        if isinstance(node.func, ast.Name) and node.func.id in BANNED_FUNCTIONS:
+            banned.append(f"{node.func.id}()")
+        elif isinstance(node.func, ast.Attribute) and node.func.attr in BANNED_METHODS:
+            banned.append(f".{node.func.attr}()")
+    return sorted(set(banned))
+
+def load_context_from_file(file_path):
+    try:
+        with open(file_path, "r") as file:
+            return file.read()
+    except Exception as e:
+        print(f"Error loading context file: {e}")
+        return "No guidelines available."
+
+# The guidelines and prompt template never change, load them once instead of on every generate
+_GUIDELINES = load_context_from_file(Path("./documents/cadquery-improvement-guide.md"))
+
+@functools.lru_cache(maxsize=1)
+def _get_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
+    return ChatPromptTemplate.from_messages([
+        ("system", SYSTEM_TEMPLATE),
+        ("human", HUMAN_TEMPLATE),
+    ]).partial(guidelines=_GUIDELINES, examples=FEW_SHOT_EXAMPLES)
+
+class RetrieveContext(Node):
+    def prep(self, shared):
+        return shared["query"]
+    
+    def exec(self, query):
+        return list(_search(query, 5))
     
     def post(self, shared, prep_res, exec_res):
-        context_text = self._build_base_context()
-        for chunk in exec_res:
-            context_text += "\n\n---\n\n" + chunk[0].page_content
-        shared["context"] = context_text
-        shared["sources"] = [chunk[0].metadata.get("id", None) for chunk in exec_res]
+        # Judge each chunk from its similarity score instead of asking the LLM to rate the context
+        kept = [chunk for chunk in exec_res if chunk[1] <= MAX_CONTEXT_DISTANCE]
+        shared["context_evaluation"] = [chunk[1] for chunk in exec_res]
+        shared["context"] = "\n\n---\n\n".join(chunk[0].page_content for chunk in kept)
+        shared["sources"] = [chunk[0].metadata.get("id", None) for chunk in kept]
+        if not kept:
+            logging.warning("No retrieved chunk is relevant enough, generating without context")
+            return "insufficient_context"
         return "default"
 
-    def _build_base_context(self):
-        return """
-        ---
-        Example 1:
-        Request: Create a cylinder with a 1-inch diameter and 2-inch height.
-        Output:
-        import cadquery as cq
-        result = cq.Workplane("XY").cylinder("2", 0.5, centered=(True, True, False))
-        ---
-
-        Example 2:
-        Request: Create a nut with a 1/2 inch diameter.
-        Output:
-        import cadquery as cq
-        diameter = 0.5
-        height = 0.25
-        result = cq.Workplane("XY").circle(diameter / 2).extrude(height)
-        .faces("<Z").workplane().hole(diameter / 4)
-        ---
-        """
-
 class GenerateCode(Node):
-    guidelines_path = Path("./documents/cadquery-improvement-guide.md")
-    def load_context_from_file(self, file_path):
-        try:
-            with open(file_path, "r") as file:
-                return file.read()
-        except Exception as e:
-            print(f"Error loading context file: {e}")
-            return "No guidelines available."
+    def __init__(self, on_token=None, **kwargs):
+        super().__init__(**kwargs)
+        # Optional callback receiving each streamed token, and a newline once the completion ends
+        self.on_token = on_token
 
     def prep(self, shared):
-        prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-        return prompt_template.format(
-            context=self.load_context_from_file(self.guidelines_path), 
-            question=shared["query"]
-        )
+        question = shared["query"]
+        # On a retry tell the model why its previous attempt was rejected
+        verification = shared.get("code_verification")
+        if shared.get("generation_attempts", 0) > 0 and verification not in (None, "valid"):
+            question += f"\n\nPrevious attempt was rejected: {verification}"
+        return _get_prompt().format_messages(context=shared["context"], question=question)
     
     def exec(self, prompt):
-        model = get_openai_model(temperature=0.2)
-        response = model.invoke(prompt)
-        return response.content.strip()
+        model = get_openai_model(temperature=0.2, task="generate")
+        # Stream the completion so output shows up as soon as the first tokens arrive
+        chunks = []
+        for chunk in model.stream(prompt):
+            if self.on_token is not None:
+                self.on_token(chunk.content)
+            chunks.append(chunk.content)
+        if self.on_token is not None:
+            self.on_token("\n")
+        return "".join(chunks).strip()
     
     def post(self, shared, prep_res, exec_res):
         shared["code_response"] = exec_res
+        shared["response_streamed"] = self.on_token is not None
+        shared["generation_attempts"] = shared.get("generation_attempts", 0) + 1
+        shared.pop("_eval_bundle", None)  # Review of the previous attempt no longer applies
         return "default"
 
+_nbf = None
+
+def _nb():
+    global _nbf
+    if _nbf is None:
+        import nbformat as _nbf
+    return _nbf
+
+def append_to_notebook(query_text, code_response):
+    nbf = _nb()
+    notebook_dir = "./query"
+    notebook_filename = os.path.join(notebook_dir, "result.ipynb")
+    code_response_py = strip_code_fences(code_response)
+    
+    # Create directory if it doesn't exist
+    os.makedirs(notebook_dir, exist_ok=True)
+    
+    # Create a new notebook if it doesn't exist
+    if not os.path.exists(notebook_filename):
+        nb = nbf.v4.new_notebook()
+    else:
+        try:
+            with open(notebook_filename, "r") as f:
+                nb = nbf.read(f, as_version=4)
+        except:
+            # If file exists but is corrupted/empty, create a new notebook
+            nb = nbf.v4.new_notebook()
+    
+    new_code = "###"+query_text.replace("\n","\n##")+"\n"+code_response_py
+    new_code_cell = nbf.v4.new_code_cell(new_code)
+    if "id" in new_code_cell:
+        del new_code_cell["id"]
+    nb.cells.append(new_code_cell)
+    
+    with open(notebook_filename, "w") as f:
+        nbf.write(nb, f)
+    return True
+
+def _log_notebook_error(future):
+    if future.exception() is not None:
+        logging.error(f"Failed to save response to notebook: {future.exception()}")
+
+# Single worker so notebook writes happen in query order
+_NOTEBOOK_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
 class SaveToNotebook(Node):
     def prep(self, shared):
         return shared["query"], shared["code_response"]
     
     def exec(self, inputs):
-        import os
-        import nbformat as nbf
-        
-        query_text, code_response = inputs
-        notebook_dir = "./query"
-        notebook_filename = os.path.join(notebook_dir, "result.ipynb")
-        code_response_py = code_response.replace("```python","").replace("```","").strip()
-        
-        # Create directory if it doesn't exist
-        os.makedirs(notebook_dir, exist_ok=True)
-        
-        # Create a new notebook if it doesn't exist
-        if not os.path.exists(notebook_filename):
-            nb = nbf.v4.new_notebook()
-        else:
-            try:
-                with open(notebook_filename, "r") as f:
-                    nb = nbf.read(f, as_version=4)
-            except:
-                # If file exists but is corrupted/empty, create a new notebook
-                nb = nbf.v4.new_notebook()
-        
-        new_code = "###"+query_text.replace("\n","\n##")+"\n"+code_response_py
-        new_code_cell = nbf.v4.new_code_cell(new_code)
-        if "id" in new_code_cell:
-            del new_code_cell["id"]
-        nb.cells.append(new_code_cell)
-        
-        with open(notebook_filename, "w") as f:
-            nbf.write(nb, f)
-        return True
+        # Rewriting the notebook grows with its size, keep it off the request path
+        future = _NOTEBOOK_EXECUTOR.submit(append_to_notebook, *inputs)
+        future.add_done_callback(_log_notebook_error)
+        return future
     
     def post(self, shared, prep_res, exec_res):
-        logging.info(f"\n\n\033[32mResponse: {shared['code_response']}\033[0m\n\nSources: {shared['sources']}]")
+        # Streamed responses were already shown as they were generated
+        if not shared.get("response_streamed"):
+            logging.info(f"\n\n\033[32mResponse: {shared['code_response']}\033[0m")
+        logging.info(f"Sources: {shared['sources']}")
         return "default"
 
 class EvaluateContext(Node):
     def prep(self, shared):
-        return shared["context"], shared["query"]
+        return shared["context"], shared["query"], shared["code_response"]
     
     def exec(self, inputs):
-        context, query = inputs
-        model = get_openai_model(temperature=0.0)  # Lower temperature for evaluation
-        evaluation = model.invoke(f"Rate how relevant this context is to the query: {query}\n\nContext: {context}")
-        return evaluation.content
+        context, query, code_response = inputs
+        # Rate the context and the code in one call, VerifyCode reuses the result from shared["_eval_bundle"]
+        model = get_openai_model(temperature=0.0).with_structured_output(GenerationReview)  # Lower temperature for evaluation
+        return model.invoke(REVIEW_TEMPLATE.format(question=query, context=context, code=code_response))
     
     def post(self, shared, prep_res, exec_res):
-        shared["context_evaluation"] = exec_res
-        # If evaluation is poor, you could trigger additional retrieval
+        shared["_eval_bundle"] = exec_res
+        if exec_res["context_ok"]:
+            return "default"
+        logging.info(f"Context rated as not relevant: {exec_res['reasons']}")
+        # Only regenerate when the code is rejected too, then drop the context that likely misled it
+        if not exec_res["code_ok"] and shared["context"]:
+            shared["context"] = ""
+            shared["sources"] = []
+            shared["code_verification"] = f"Review: {exec_res['reasons']}"
+            return "insufficient_context"
         return "default"  
 
-class DecomposeTask(Node):
-    def prep(self, shared):
+class DecomposeTask(AsyncNode):
+    async def prep_async(self, shared):
         return shared["query"]
     
-    def exec(self, query):
+    async def exec_async(self, query):
         model = get_openai_model(temperature=0.3)
         prompt = f"Break down this CadQuery task into steps: {query}"
-        steps = model.invoke(prompt)
+        steps = await model.ainvoke(prompt)
         return steps.content
     
-    def post(self, shared, prep_res, exec_res):
+    async def post_async(self, shared, prep_res, exec_res):
         shared["task_steps"] = exec_res
         return "default"
 
-class AnalyzeQuery(Node):
-    def prep(self, shared):
+class AnalyzeQuery(AsyncNode):
+    async def prep_async(self, shared):
         return shared["query"]
     
-    def exec(self, query):
+    async def exec_async(self, query):
         model = get_openai_model(temperature=0.1)
-        analysis = model.invoke(f"Analyze the type of query: {query}")
+        analysis = await model.ainvoke(f"Analyze the type of query: {query}")
         return analysis.content
     
-    def post(self, shared, prep_res, exec_res):
+    async def post_async(self, shared, prep_res, exec_res):
         shared["query_type"] = exec_res
         return "default"
 
 class VerifyCode(Node):
     def prep(self, shared):
-        return shared["code_response"]
+        return shared["code_response"], shared.get("_eval_bundle")
     
-    def exec(self, code_response):
-        model = get_openai_model(temperature=0.0)  # Lower temperature for verification
-        verification = model.invoke(f"Verify the validity of the following CadQuery code:\n\n{code_response}")
-        return verification.content
+    def exec(self, inputs):
+        # Check the code locally instead of asking the LLM, returns None if it is valid
+        code_response, bundle = inputs
+        code = strip_code_fences(code_response)
+        try:
+            tree = ast.parse(code)
+            compile(tree, "<generated>", "exec")
+        except SyntaxError as e:
+            return f"Syntax error: {e}"
+        banned = find_banned_calls(tree)
+        if banned:
+            return f"Uses banned calls: {', '.join(banned)}"
+        # Reuse the LLM review when EvaluateContext already ran
+        if bundle is not None and not bundle["code_ok"]:
+            return f"Review: {bundle['reasons']}"
+        return None
     
     def post(self, shared, prep_res, exec_res):
-        shared["code_verification"] = exec_res
-        return "default"
+        shared["code_verification"] = exec_res or "valid"
+        if exec_res is None:
+            return "default"
+        if shared.get("generation_attempts", 0) >= MAX_GENERATION_ATTEMPTS:
+            logging.warning(f"Generated code is still invalid after {MAX_GENERATION_ATTEMPTS} attempts: {exec_res}")
+            return "default"
+        logging.info(f"Generated code is invalid, regenerating: {exec_res}")
+        return "invalid_code"
 
-def create_cadquery_flow():
+async def run_parallel_prep(shared):
+    # Analyze, decompose and retrieve only depend on shared["query"], run them concurrently
+    # (langchain-chroma is sync only, so the retrieve node runs in a worker thread)
+    await asyncio.gather(
+        AnalyzeQuery()._run_async(shared),
+        DecomposeTask()._run_async(shared),
+        asyncio.to_thread(RetrieveContext()._run, shared),
+    )
+
+def create_cadquery_flow(verbose=False, on_token=None):
     # Create nodes
-    retrieve = RetrieveContext()
-    analyze = AnalyzeQuery()         # New node to analyze query type
-    decompose = DecomposeTask()      # New node to break down complex tasks
-    evaluate = EvaluateContext()     # New node to evaluate context quality
-    generate = GenerateCode()
-    verify = VerifyCode()            # New node to check code validity
+    generate = GenerateCode(on_token=on_token)
+    verify = VerifyCode()            # Local syntax check, no LLM call
     save = SaveToNotebook()
     
     # Connect nodes with branching logic
-    analyze >> decompose >> retrieve >> evaluate >> generate >> verify >> save
+    if verbose:
+        # Debug mode: analyze, decompose and retrieve run beforehand in run_parallel_prep,
+        # and the generated code gets an LLM review of context and code
+        evaluate = EvaluateContext()
+        generate >> evaluate >> verify >> save
+        evaluate - "insufficient_context" >> generate  # Regenerate without the irrelevant context
+        start = generate
+    else:
+        retrieve = RetrieveContext()
+        retrieve >> generate >> verify >> save
+        retrieve - "insufficient_context" >> generate  # Generate without the poor context
+        start = retrieve
     
     # Add error handling paths
-    evaluate - "insufficient_context" >> retrieve  # Loop back if context is poor
     verify - "invalid_code" >> generate            # Regenerate if code is invalid
     
-    return Flow(start=analyze)
+    return Flow(start=start)
 
-def query_rag(query_text: str):
+def query_rag(query_text: str, verbose: bool = False, on_token=None):
     try:
-        flow = create_cadquery_flow()
         shared = {"query": query_text}
+
+        # Near duplicate of an earlier query, reuse its response instead of running the flow
+        query_embedding = _embed_query(query_text)
+        query_numbers = extract_numbers(query_text)
+        cached = _lookup_cached_response(query_embedding, query_numbers)
+        if cached is not None:
+            logging.info("Semantic cache hit, reusing previous response")
+            shared["code_response"], shared["sources"] = cached
+            SaveToNotebook().run(shared)
+            return
+
+        # Query analysis and task decomposition are never read downstream, only run them when debugging
+        if verbose:
+            _get_event_loop().run_until_complete(run_parallel_prep(shared))
+        flow = create_cadquery_flow(verbose=verbose, on_token=on_token)
         flow.run(shared)
+        # Do not serve code that failed verification to later queries
+        if shared.get("code_verification") == "valid":
+            _RESPONSE_CACHE.append((query_embedding, query_numbers, shared["code_response"], shared["sources"]))
     except Exception as e:
         logging.error(f"An error occurred: {e}")
 
+def _write_token(token):
+    sys.stdout.write(token)
+    sys.stdout.flush()
+
 def main():
     query_text = """
     Write a Python script using CadQuery to create a cylinder with another cylinder twisted to a semicircle and attached to the first cylinder to resemble a parametric mug with a three-circle emblem attached to the front. The script should:
@@ -276,7 +536,7 @@ def main():
             - Ensure the final object is a valid solid
             - Ensure that the output is displayed with display(item) instead of show_object(item), "item" being the variable name of the final object
     """
-    query_rag(query_text)
+    query_rag(query_text, on_token=_write_token)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file